@@ -4,7 +4,7 @@
 
 # Package classes
 from transports import BinaryNetStreamTransport
-from sender import NetStreamSender, NetStreamProxyGraph
+from sender import NetStreamSender, NetStreamStepSender, NetStreamStepStats, NetStreamProxyGraph
 
 # Event codes constants
 EVENT_GETVERSION = 0x00
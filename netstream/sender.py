@@ -1,4 +1,4 @@
-#pylint: disable=R0913,C0301
+#pylint: disable=R0902,R0913,C0301
 
 """NetStream sending classes."""
 
@@ -6,6 +6,7 @@ import netstream
 import encoders
 import struct
 import random
+import time
 import logging
 
 class NetStreamSender(object):
@@ -296,6 +297,197 @@ class NetStreamSender(object):
             "attr": attr
         })
 
+class NetStreamStepStats(object):
+    """Transport and latency statistics of a step sender."""
+
+    def __init__(self, smoothing=0.2):
+        """Initialise using the smoothing factor of the moving averages."""
+        self.smoothing = smoothing
+        self.drain_rate = None
+        self.write_time = None
+        self.write_size = None
+        self.step_size = None
+        self.step_interval = None
+        self.batch_size = 0
+        self.batch_latency = None
+        self.mean_latency = None
+        self.max_latency = None
+        self.steps_sent = 0
+        self.steps_dropped = 0
+
+    def smooth(self, average, value):
+        """Compute an exponentially weighted moving average."""
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def record_interval(self, interval):
+        """Record the time between two step beginnings."""
+        self.step_interval = self.smooth(self.step_interval, interval)
+
+    def record_step(self, size):
+        """Record the size of a completed step."""
+        self.step_size = self.smooth(self.step_size, size)
+
+    def record_write(self, size, elapsed, min_size, min_time):
+        """Record a completed write, ignoring small writes for the drain rate."""
+        self.write_time = self.smooth(self.write_time, elapsed)
+        self.write_size = self.smooth(self.write_size, size)
+        if size >= min_size:
+            self.drain_rate = self.smooth(self.drain_rate, size / max(elapsed, min_time))
+
+    def record_latencies(self, latencies):
+        """Record the latencies of the steps written in one batch."""
+        self.batch_size = len(latencies)
+        self.batch_latency = max(latencies)
+        for latency in latencies:
+            self.mean_latency = self.smooth(self.mean_latency, latency)
+        if self.max_latency is None or self.batch_latency > self.max_latency:
+            self.max_latency = self.batch_latency
+        self.steps_sent += len(latencies)
+
+class NetStreamStepSender(NetStreamSender):
+    """Sender that groups graph events by step and sends them in batches.
+
+    Events between two step_begun() calls are treated as a unit and are never
+    split across writes, unless flush() is called in the middle of a step.
+    With a frame budget, completed steps are coalesced into a single write
+    unless holding the oldest one until the next step would exceed the
+    budget. The number of steps per write therefore adapts to the measured
+    step interval, write time and transport drain rate. A write only exceeds
+    the flush size derived from the drain rate when a single step does.
+
+    Until a first write has been timed, every step is sent on its own.
+
+    There is no timer: pending steps are only examined when a new step begins,
+    so the frame budget is only honoured while step_begun() keeps being
+    called. Call flush_steps() or flush() when the producer goes idle.
+    """
+
+    def __init__(self, transport, stream_id="default", frame_budget=None,
+                 min_flush_size=1024, max_flush_size=1048576,
+                 min_write_time=0.001, smoothing=0.2):
+        """Initialise using transport, an optional stream ID and tuning options.
+
+        The frame budget is the target step latency in seconds. Without a
+        frame budget, every step is sent as soon as it is complete. Writes
+        smaller than the minimum flush size do not update the drain rate, and
+        write times below the minimum write time are rounded up to it.
+        """
+        if min_flush_size > max_flush_size:
+            raise ValueError("minimum flush size is greater than maximum flush size")
+        self.frame_budget = frame_budget
+        self.min_flush_size = min_flush_size
+        self.max_flush_size = max_flush_size
+        self.min_write_time = min_write_time
+        self.flush_size = max_flush_size
+        self.stats = NetStreamStepStats(smoothing)
+        self.step_buff = bytearray()
+        self.step_started = time.time()
+        self.step_begun_time = None
+        self.pending_buff = bytearray()
+        self.pending_steps = []
+        super(NetStreamStepSender, self).__init__(transport, stream_id)
+
+    def send_event(self, event):
+        """Buffer a graph event into the current step."""
+        self.step_buff.extend(struct.pack("!i", self.stream_id_length + len(event)))
+        self.step_buff.extend(self.stream_id_buff)
+        self.step_buff.extend(event)
+
+    def step_begun(self, source_id, time_id, timestamp):
+        """A new step begun, completing the current one."""
+        now = time.time()
+        if self.step_begun_time is not None:
+            self.stats.record_interval(now - self.step_begun_time)
+        self.step_begun_time = now
+        if self.pending_steps and \
+                len(self.pending_buff) + len(self.step_buff) > self.flush_size:
+            self.flush_steps()
+        self.end_step()
+        if self.must_flush():
+            self.flush_steps()
+        super(NetStreamStepSender, self).step_begun(source_id, time_id, timestamp)
+
+    def end_step(self):
+        """Move the current step to the pending batch."""
+        if self.step_buff:
+            self.stats.record_step(len(self.step_buff))
+            self.pending_buff.extend(self.step_buff)
+            self.pending_steps.append(self.step_started)
+            self.step_buff = bytearray()
+        self.step_started = time.time()
+
+    def expected_write_time(self, size):
+        """Estimate the time needed to write a batch, or None if unknown."""
+        write_time = self.stats.write_time
+        if write_time is None:
+            return None
+        rate = self.stats.drain_rate
+        if rate is None and write_time > 0:
+            rate = self.stats.write_size / write_time
+        if not rate:
+            return write_time
+        return max(write_time, size / rate)
+
+    def must_flush(self):
+        """Check whether the pending batch must be written before the next step."""
+        if not self.pending_steps:
+            return False
+        if self.frame_budget is None:
+            return True
+        size = len(self.pending_buff) + (self.stats.step_size or 0)
+        if size >= self.flush_size:
+            return True
+        write_time = self.expected_write_time(size)
+        if write_time is None:
+            return True
+        age = time.time() - self.pending_steps[0]
+        interval = self.stats.step_interval or 0.0
+        return age + interval + write_time >= self.frame_budget
+
+    def flush(self):
+        """Write all pending steps, including the current one.
+
+        Events added after this call go out as a separate unit without a
+        leading step event, so calling it in the middle of a step splits
+        that step. Use flush_steps() to keep the current step whole.
+        """
+        self.end_step()
+        return self.flush_steps()
+
+    def flush_steps(self):
+        """Write all completed steps to the remote server."""
+        if not self.pending_steps:
+            return True
+        buff = self.pending_buff
+        steps = self.pending_steps
+        self.pending_buff = bytearray()
+        self.pending_steps = []
+        started = time.time()
+        sent = self.transport.send(buff)
+        finished = time.time()
+        if not sent:
+            self.stats.steps_dropped += len(steps)
+            logging.error("steps dropped: %s", {
+                "steps": len(steps),
+                "bytes": len(buff)
+            })
+            return False
+        self.stats.record_write(len(buff), finished - started,
+                                self.min_flush_size, self.min_write_time)
+        self.stats.record_latencies([finished - step for step in steps])
+        if self.frame_budget is not None and self.stats.drain_rate is not None:
+            flush_size = int(self.stats.drain_rate * self.frame_budget)
+            self.flush_size = max(self.min_flush_size, min(self.max_flush_size, flush_size))
+        logging.debug("steps flushed: %s", {
+            "steps": self.stats.batch_size,
+            "bytes": len(buff),
+            "write_time": finished - started,
+            "batch_latency": self.stats.batch_latency
+        })
+        return True
+
 class NetStreamProxyGraph(object):
     """Proxy object for sending graph events."""
 
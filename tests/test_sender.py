@@ -0,0 +1,218 @@
+"""Tests for the step-synchronized sender."""
+
+import struct
+import unittest
+
+import netstream
+from netstream import sender
+
+class FakeClock(object):
+    """Manually advanced replacement for the time module."""
+
+    def __init__(self):
+        """Initialise at time zero."""
+        self.now = 0.0
+
+    def time(self):
+        """Return the current fake time."""
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the fake time."""
+        self.now += seconds
+
+class StubTransport(object):
+    """Transport recording writes that take a fixed time plus a time per byte."""
+
+    def __init__(self, clock, write_time=0.0, rate=None, fail=False):
+        """Initialise using a clock, a write time, a byte rate and a failure flag."""
+        self.clock = clock
+        self.write_time = write_time
+        self.rate = rate
+        self.fail = fail
+        self.writes = []
+
+    def connect(self):
+        """Pretend to connect."""
+        return True
+
+    def send(self, data):
+        """Record a write unless failing."""
+        self.clock.sleep(self.write_time)
+        if self.rate:
+            self.clock.sleep(len(data) / float(self.rate))
+        if self.fail:
+            return False
+        self.writes.append(bytes(data))
+        return True
+
+def split_events(data):
+    """Split raw sender output into the event codes it contains."""
+    codes = []
+    offset = 0
+    while offset < len(data):
+        length = struct.unpack("!i", data[offset:offset + 4])[0]
+        event = bytearray(data[offset + 4:offset + 4 + length])
+        codes.append(event[len(netstream.encoders.encode_string("default"))])
+        offset += 4 + length
+    return codes
+
+class NetStreamStepSenderTest(unittest.TestCase):
+    """Behaviour of NetStreamStepSender."""
+
+    def setUp(self):
+        """Replace the clock used by the sender."""
+        self.clock = FakeClock()
+        self.real_time = sender.time
+        sender.time = self.clock
+
+    def tearDown(self):
+        """Restore the real clock."""
+        sender.time = self.real_time
+
+    def run_steps(self, step_sender, steps, interval, nodes=1):
+        """Produce a number of steps with some nodes each."""
+        proxy = netstream.NetStreamProxyGraph(step_sender, "test")
+        for step in range(steps):
+            proxy.step_begins(float(step))
+            for node in range(nodes):
+                proxy.add_node("{}_{}".format(step, node))
+            self.clock.sleep(interval)
+
+    def test_one_write_per_step_without_budget(self):
+        """Every step is written on its own without a frame budget."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport)
+        self.run_steps(step_sender, 5, 0.01)
+        step_sender.flush()
+        self.assertEqual(len(transport.writes), 5)
+        for write in transport.writes:
+            self.assertEqual(split_events(write),
+                             [netstream.EVENT_STEP, netstream.EVENT_ADD_NODE])
+
+    def test_steps_never_split(self):
+        """Every write starts with a step event and keeps the event order."""
+        transport = StubTransport(self.clock, write_time=0.001)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=0.05)
+        self.run_steps(step_sender, 20, 0.01)
+        step_sender.flush()
+        codes = []
+        for write in transport.writes:
+            events = split_events(write)
+            self.assertEqual(events[0], netstream.EVENT_STEP)
+            codes.extend(events)
+        self.assertEqual(codes, [netstream.EVENT_STEP, netstream.EVENT_ADD_NODE] * 20)
+
+    def test_batches_while_under_budget(self):
+        """Steps are coalesced once a write has been timed."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=1.0)
+        self.run_steps(step_sender, 10, 0.01)
+        step_sender.flush()
+        self.assertEqual(len(transport.writes), 2)
+        self.assertEqual(split_events(transport.writes[0]),
+                         [netstream.EVENT_STEP, netstream.EVENT_ADD_NODE])
+        self.assertEqual(step_sender.stats.batch_size, 9)
+        self.assertAlmostEqual(step_sender.stats.batch_latency, 0.09)
+        self.assertEqual(step_sender.stats.steps_sent, 10)
+
+    def test_flushes_before_budget_is_missed(self):
+        """Steps are not held when the next one would miss the budget."""
+        transport = StubTransport(self.clock, write_time=0.001)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=0.033)
+        self.run_steps(step_sender, 20, 0.02)
+        step_sender.flush()
+        self.assertEqual(len(transport.writes), 20)
+        self.assertTrue(step_sender.stats.max_latency <= 0.033)
+
+    def test_no_latency_on_failed_send(self):
+        """Failed writes count dropped steps but no latency."""
+        transport = StubTransport(self.clock, fail=True)
+        step_sender = netstream.NetStreamStepSender(transport)
+        self.run_steps(step_sender, 3, 0.01)
+        self.assertFalse(step_sender.flush())
+        self.assertEqual(step_sender.stats.steps_dropped, 3)
+        self.assertEqual(step_sender.stats.steps_sent, 0)
+        self.assertEqual(step_sender.stats.batch_latency, None)
+        self.assertEqual(step_sender.stats.max_latency, None)
+
+    def test_flush_sends_current_step(self):
+        """flush() writes the step in progress."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=1.0)
+        proxy = netstream.NetStreamProxyGraph(step_sender, "test")
+        proxy.step_begins(0.0)
+        proxy.add_node("a")
+        self.assertEqual(transport.writes, [])
+        self.assertTrue(step_sender.flush())
+        self.assertEqual(len(transport.writes), 1)
+        self.assertEqual(split_events(transport.writes[0]),
+                         [netstream.EVENT_STEP, netstream.EVENT_ADD_NODE])
+
+    def test_small_writes_do_not_set_drain_rate(self):
+        """Writes below the minimum flush size leave the drain rate unset."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=0.033)
+        self.run_steps(step_sender, 3, 0.02)
+        step_sender.flush()
+        self.assertEqual(step_sender.stats.drain_rate, None)
+        self.assertEqual(step_sender.flush_size, step_sender.max_flush_size)
+
+    def test_instant_writes_use_min_write_time(self):
+        """Instant writes are timed as taking the minimum write time."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=0.033,
+                                                    min_flush_size=16)
+        self.run_steps(step_sender, 1, 0.02)
+        step_sender.flush()
+        size = len(transport.writes[0])
+        self.assertAlmostEqual(step_sender.stats.drain_rate, size / 0.001)
+        self.assertEqual(step_sender.flush_size, max(16, int(size / 0.001 * 0.033)))
+
+    def test_first_batch_within_budget(self):
+        """Holding steps never misses the budget on a slow transport."""
+        for rate in (1000000, 200000):
+            self.clock.now = 0.0
+            transport = StubTransport(self.clock, rate=rate)
+            step_sender = netstream.NetStreamStepSender(transport, frame_budget=0.05)
+            self.run_steps(step_sender, 50, 0.005, nodes=20)
+            step_sender.flush()
+            self.assertTrue(len(transport.writes) < 50)
+            self.assertTrue(step_sender.stats.max_latency <= 0.05)
+
+    def test_writes_respect_flush_size(self):
+        """Writes only exceed the flush size when holding a single step."""
+        transport = StubTransport(self.clock, rate=1000000)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=1.0,
+                                                    min_flush_size=100,
+                                                    max_flush_size=1000)
+        self.run_steps(step_sender, 50, 0.001, nodes=4)
+        step_sender.flush()
+        self.assertTrue(len(transport.writes) > 1)
+        for write in transport.writes:
+            steps = split_events(write).count(netstream.EVENT_STEP)
+            self.assertTrue(len(write) <= 1000 or steps == 1)
+
+    def test_rejects_inverted_flush_sizes(self):
+        """The minimum flush size cannot exceed the maximum flush size."""
+        transport = StubTransport(self.clock)
+        self.assertRaises(ValueError, netstream.NetStreamStepSender, transport,
+                          min_flush_size=1024, max_flush_size=1000)
+
+    def test_flush_steps_keeps_current_step(self):
+        """flush_steps() only writes completed steps."""
+        transport = StubTransport(self.clock)
+        step_sender = netstream.NetStreamStepSender(transport, frame_budget=1.0)
+        proxy = netstream.NetStreamProxyGraph(step_sender, "test")
+        proxy.step_begins(0.0)
+        proxy.add_node("a")
+        self.assertTrue(step_sender.flush_steps())
+        self.assertEqual(transport.writes, [])
+        proxy.add_node("b")
+        step_sender.flush()
+        self.assertEqual(split_events(transport.writes[0]),
+                         [netstream.EVENT_STEP, netstream.EVENT_ADD_NODE,
+                          netstream.EVENT_ADD_NODE])
+
+if __name__ == "__main__":
+    unittest.main()